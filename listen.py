@@ -29,6 +29,7 @@ def listen(file: str) -> None:
             path=directory,
             extensions=params.extensions,
             recursion_limit=params.recursion_limit,
+            ignore_dirs=params.ignore_dirs,
         )
 
         dirs.append(tmp)
@@ -39,6 +40,7 @@ def listen(file: str) -> None:
         chat_id=parameters.chat_id,
         directories=dirs,
         wait_time=parameters.wait_time,
+        force_polling=parameters.force_polling,
     )
 
 
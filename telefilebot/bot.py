@@ -1,20 +1,169 @@
-from typing import List, Dict
+from typing import List, Dict, Optional, Set, Tuple
 import time
 import math
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
 import telegram
+from telegram.error import BadRequest, NetworkError, RetryAfter
+from telegram.utils.request import Request
 
 from .utils.logging import setup_logger
 
+try:
+
+    from watchfiles import Change, watch
+
+    has_watchfiles = True
+
+except ImportError:
+
+    has_watchfiles = False
+
 
 from .directory import Directory
 
 
 logger = setup_logger(__name__)
 
+# adaptive token bucket parameters: the rate is cut by
+# _RATE_ALPHA on a flood wait and grows by _RATE_DELTA
+# (half a message per minute) after every delivered message
+
+_RATE_ALPHA: float = 0.5
+_RATE_DELTA: float = 0.5 / 60.0
+
+# telegram rejects messages longer than 4096 characters,
+# leave some room for the part counter
+
+_MAX_MESSAGE_LENGTH: int = 4000
+
+# the fixed pieces of the batch message
+
+_H_NEW: str = "NEW FILES"
+_H_MOD: str = "MODIFIED FILES"
+_H_DEL: str = "DELETED FILES"
+_H_COUNT: str = " changes"
+
+# the kinds of change in the order they are listed
+
+_SECTIONS: Tuple[Tuple[str, str], ...] = (
+    ("new", _H_NEW),
+    ("modified", _H_MOD),
+    ("deleted", _H_DEL),
+)
+
+
+def _split_message(message: str, max_length: int = _MAX_MESSAGE_LENGTH) -> List[str]:
+    """
+    split a message into numbered parts that fit into a telegram
+    message, breaking at line ends where possible
+
+    :param message: the message to split
+    :param max_length: the longest a part may be
+    :returns:
+
+    """
+
+    parts: List[str] = []
+
+    while len(message) > max_length:
+
+        cut = message.rfind("\n", 0, max_length)
+
+        if cut <= 0:
+
+            # a single line that is too long
+
+            cut = max_length
+
+        parts.append(message[:cut])
+
+        message = message[cut:].lstrip("\n")
+
+    parts.append(message)
+
+    if len(parts) > 1:
+
+        n_parts = len(parts)
+
+        parts = [f"({i}/{n_parts})\n{part}" for i, part in enumerate(parts, 1)]
+
+    return parts
+
+
+class _TokenBucket:
+    def __init__(
+        self,
+        capacity: float,
+        rate: float,
+        rate_min: Optional[float] = None,
+        rate_max: Optional[float] = None,
+    ) -> None:
+        """
+        a token bucket that refills lazily whenever it is looked at.
+        the refill rate adapts between rate_min and rate_max
+
+        :param capacity: the maximum number of tokens the bucket holds
+        :param rate: the number of tokens added per second
+        :param rate_min: the lowest rate the bucket will back off to
+        :param rate_max: the highest rate the bucket will recover to
+        :returns:
+        :rtype:
+
+        """
+
+        self.capacity: float = capacity
+        self.rate: float = rate
+        self.rate_min: float = rate if rate_min is None else rate_min
+        self.rate_max: float = rate if rate_max is None else rate_max
+        self.tokens: float = capacity
+        self.last: float = time.monotonic()
+
+    def refill(self, now: float) -> None:
+
+        # the bucket is paused until last after a flood wait
+
+        if now <= self.last:
+
+            return
+
+        self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def time_until_token(self, now: float) -> float:
+        """
+        the number of seconds until a full token is available
+
+        """
+
+        pause = max(0.0, self.last - now)
+
+        if self.tokens >= 1:
+
+            return pause
+
+        return pause + (1 - self.tokens) / self.rate
+
+    def increase_rate(self, delta: float) -> None:
+
+        self.rate = min(self.rate_max, self.rate + delta)
+
+    def decrease_rate(self, alpha: float, retry_after: float) -> None:
+
+        self.rate = max(self.rate_min, self.rate * alpha)
+        self.tokens = 0.0
+        self.last = time.monotonic() + retry_after
+
 
 class TeleFileBot:
     def __init__(
-        self, name: str, token: str, chat_id: str, directories: List[Directory], wait_time: int
+        self,
+        name: str,
+        token: str,
+        chat_id: str,
+        directories: List[Directory],
+        wait_time: int,
+        force_polling: bool = False,
     ) -> None:
         """
         A generic telegram bot
@@ -22,26 +171,160 @@ class TeleFileBot:
         :param name: the name of the bot
         :param token: the bot token
         :param chat_id: the chat id to talk to
+        :param directories: the directories to watch
+        :param wait_time: the time between checks in minutes
+        :param force_polling: rescan the directories instead of
+        using file system events even if watchfiles is installed
         :returns:
         :rtype:
 
         """
 
-        logger.debug(f"{name} bot is being constructed")
+        logger.debug("%s bot is being constructed", name)
 
         # create the bot
 
         self._name: str = name
         self._chat_id: str = chat_id
 
-        self._bot: telegram.Bot = telegram.Bot(token=token)
+        # after the start up message only the notifier thread sends,
+        # so a single kept-alive connection is reused for everything
+
+        self._request: Request = Request(con_pool_size=1)
+
+        self._bot: telegram.Bot = telegram.Bot(token=token, request=self._request)
 
         self._msg_header = ""
 
+        # the parts of the messages that never change
+
+        self._batch_header_prefix: str = f"{name} detected "
+
         self._directories: List[Directory] = directories
 
         self._wait_time: int = int(math.ceil(60 * wait_time)) # in seconds
 
+        self._force_polling: bool = force_polling
+
+        # changes waiting to be sent, keyed by their path
+
+        self._pending: Dict[str, str] = {}
+
+        self._max_pending: int = 100
+
+        # how long changes are held back to be sent together (in seconds)
+
+        self._debounce_time: float = 0.5
+
+        self._last_flush: float = time.monotonic()
+
+        # the checks only collect changes and errors, a separate
+        # thread sends them so that the checks never wait on telegram
+
+        self._pending_lock: threading.Lock = threading.Lock()
+
+        self._changes_ready: threading.Event = threading.Event()
+
+        self._error_queued: bool = False
+
+        # changes the notifier has taken but not sent yet
+
+        self._in_flight: int = 0
+
+        self._closed: threading.Event = threading.Event()
+
+        self._close_timeout: float = 5.0  # seconds
+
+        self._notifier: threading.Thread = threading.Thread(
+            target=self._notify_loop, name="tfb-notify", daemon=True
+        )
+
+        # telegram allows 30 messages per second overall and
+        # 20 messages per minute into a group, so a message
+        # has to get a token from both buckets. The chat bucket
+        # backs off when telegram asks us to wait
+
+        self._buckets: List[_TokenBucket] = [
+            _TokenBucket(capacity=30, rate=30.0),
+            _TokenBucket(
+                capacity=20, rate=20 / 60.0, rate_min=1 / 60.0, rate_max=20 / 60.0
+            ),
+        ]
+
+        self._max_retries: int = 3
+
+        self._retry_delay: float = 1.0  # seconds
+
+        # after telegram could not be reached we do not try to
+        # report errors to it until this time has passed
+
+        self._transport_bad_until: float = 0.0
+
+        self._transport_cooldown: float = 60.0  # seconds
+
+        # the longest we wait after repeated failures
+
+        self._max_backoff: float = 3600.0  # seconds
+
+        # directories whose last check failed, so a broken
+        # directory is reported once and not on every pass
+
+        self._failing: Set[Directory] = set()
+
+        # a dedicated pool for the directory scans so that slow
+        # disks do not queue behind anything else in the process
+
+        self._io_pool: ThreadPoolExecutor = ThreadPoolExecutor(
+            max_workers=min(max(1, len(directories)), 8),
+            thread_name_prefix="tfb-scan",
+        )
+
+    def _rate_limit_check(self) -> None:
+        """
+        block until every bucket has a token and then
+        spend one from each of them
+
+        :returns:
+        :rtype:
+
+        """
+
+        now = time.monotonic()
+
+        for bucket in self._buckets:
+
+            bucket.refill(now)
+
+        wait = max(bucket.time_until_token(now) for bucket in self._buckets)
+
+        if wait > 0:
+
+            logger.debug("%s bot is rate limited for %.2fs", self._name, wait)
+
+            time.sleep(wait)
+
+            now = time.monotonic()
+
+            for bucket in self._buckets:
+
+                bucket.refill(now)
+
+        for bucket in self._buckets:
+
+            bucket.tokens -= 1
+
+    def _increase_rate(self) -> None:
+
+        for bucket in self._buckets:
+
+            bucket.increase_rate(_RATE_DELTA)
+
+    def _decrease_rate(self, retry_after: float) -> None:
+
+        for bucket in self._buckets:
+
+            bucket.decrease_rate(_RATE_ALPHA, retry_after)
+
     def _speak(self, message: str) -> None:
         """
         send a message
@@ -54,69 +337,531 @@ class TeleFileBot:
 
         full_msg = f"{self._msg_header}{message}"
 
-        logger.info(f"{self._name} bot is sending: {message}")
+        logger.info("%s bot is sending: %s", self._name, message)
+
+        for attempt in range(self._max_retries):
+
+            self._rate_limit_check()
+
+            try:
+
+                self._bot.send_message(chat_id=self._chat_id, text=full_msg)
+
+            except RetryAfter as e:
+
+                logger.warning(
+                    "%s bot was asked to wait %ss", self._name, e.retry_after
+                )
+
+                self._decrease_rate(e.retry_after)
+
+                if attempt == self._max_retries - 1:
+
+                    raise
+
+                continue
+
+            except BadRequest:
+
+                # a subclass of NetworkError in python-telegram-bot 13,
+                # but retrying a rejected request never helps
+
+                raise
+
+            except NetworkError as e:
+
+                if attempt == self._max_retries - 1:
 
-        self._bot.send_message(chat_id=self._chat_id, text=full_msg)
+                    logger.error(
+                        "%s bot gave up reaching telegram", self._name, exc_info=True
+                    )
 
-    # def _show(self, image: str, description: str):
-    #     """
-    #     send an image
+                    # stop trying to report errors over a
+                    # connection that is not there
 
-    #     :param image:
-    #     :param description:
-    #     :returns:
-    #     :rtype:
+                    self._transport_bad_until = (
+                        time.monotonic() + self._transport_cooldown
+                    )
 
-    #     """
+                    raise
 
-    #     full_msg = f"{self._msg_header}{description}"
+                # transient, so no traceback
 
-    #     logger.info(f"{self._name} bot is sending the {description} image")
+                logger.warning(
+                    "%s bot could not reach telegram (attempt %d/%d): %r",
+                    self._name,
+                    attempt + 1,
+                    self._max_retries,
+                    e,
+                )
+
+                time.sleep(self._retry_delay * 2 ** attempt)
+
+                continue
+
+            self._increase_rate()
+
+            return
+
+    def _queue_changes(self, directory: Directory, new_files: Dict[str, str]) -> None:
+        """
+        collect the changes of a directory until the next flush,
+        collapsing repeated changes of the same file
+
+        :param directory: the directory the changes belong to
+        :param new_files: the changes reported by the directory
+        :returns:
+        :rtype:
+
+        """
+
+        with self._pending_lock:
+
+            for k, v in new_files.items():
+
+                path = directory._path_str + k
+
+                previous: Optional[str] = self._pending.get(path)
+
+                if previous == "new":
+
+                    # a file we have not reported yet is still new
+                    # when it is modified and never existed if it is
+                    # deleted again
+
+                    if v == "deleted":
+
+                        del self._pending[path]
+
+                    continue
+
+                if previous == "deleted" and v == "new":
+
+                    # the file was replaced
+
+                    v = "modified"
+
+                self._pending[path] = v
+
+            n_pending = len(self._pending)
+
+        if n_pending >= self._max_pending:
+
+            self._flush()
+
+    def _flush(self) -> None:
+        """
+        hand the pending changes over to the notifier thread
+
+        :returns:
+        :rtype:
+
+        """
+
+        self._last_flush = time.monotonic()
+
+        self._changes_ready.set()
+
+    def _send_pending(self) -> None:
+        """
+        send all pending changes as one message. everything that
+        is queued while this is sending goes out in the next one
+
+        :returns:
+        :rtype:
+
+        """
 
-    #     self._bot.send_photo(
-    #         chat_id=self._chat_id, photo=open(image, "rb"), caption=full_msg
-        # )
+        with self._pending_lock:
+
+            pending = self._pending
+
+            self._pending = {}
+
+        if not pending:
+
+            return
+
+        # sort the files into their sections with one dict lookup each
+
+        sections: Dict[str, List[str]] = {kind: [] for kind, _ in _SECTIONS}
+
+        for k, v in pending.items():
+
+            sections[v].append(k)
+
+        # write everything into one list and join it once
+
+        parts: List[str] = [self._batch_header_prefix, str(len(pending)), _H_COUNT]
+
+        for kind, section_header in _SECTIONS:
+
+            files = sections[kind]
+
+            if not files:
+
+                continue
+
+            parts.extend(("\n\n", section_header, " (", str(len(files)), "):"))
+
+            for file_name in files:
+
+                parts.append("\n")
+                parts.append(file_name)
+
+        # send long lists in several messages that telegram accepts
+
+        self._in_flight = len(pending)
+
+        try:
+
+            for message in _split_message("".join(parts)):
+
+                self._speak(message)
+
+        except Exception:
+
+            logger.warning(
+                "%s bot dropped %d changes it could not send",
+                self._name,
+                self._in_flight,
+            )
+
+            raise
+
+        finally:
+
+            self._in_flight = 0
+
+    def _log_check_error(self, directory: Directory, error: BaseException) -> None:
+
+        # single vanished entries are skipped by the walk, so an
+        # OSError here means the directory itself is missing or
+        # unreadable. anything else deserves a traceback
+
+        if isinstance(error, OSError):
+
+            logger.error("failed to check %s: %r", directory._path, error)
+
+        else:
+
+            logger.error("failed to check %s", directory._path, exc_info=error)
+
+        if directory not in self._failing:
+
+            self._failing.add(directory)
+
+            self._queue_error()
+
+    def _check_ok(self, directory: Directory) -> None:
+
+        if directory in self._failing:
+
+            logger.info("%s can be checked again", directory._path)
+
+            self._failing.discard(directory)
 
     def _check_directories(self) -> None:
 
+        if len(self._directories) == 1:
+
+            # nothing to overlap, so skip the hand off to the pool
+
+            directory = self._directories[0]
+
+            try:
+
+                new_files: Dict[str, str] = directory.check()
+
+            except Exception as e:
+
+                self._log_check_error(directory, e)
+
+                return
+
+            self._check_ok(directory)
+
+            self._queue_changes(directory, new_files)
+
+            return
+
+        futures: Dict[Future, Directory] = {
+            self._io_pool.submit(directory.check): directory
+            for directory in self._directories
+        }
+
+        # handle each directory as soon as it is scanned so that
+        # a slow mount does not hold back the fast ones
+
+        for future in as_completed(futures):
+
+            directory = futures[future]
+
+            error: Optional[BaseException] = future.exception()
+
+            if error is not None:
+
+                self._log_check_error(directory, error)
+
+                continue
+
+            self._check_ok(directory)
+
+            self._queue_changes(directory, future.result())
+
+            if time.monotonic() - self._last_flush > self._debounce_time:
+
+                self._flush()
+
+    def _handle_changes(self, changes: Set[Tuple["Change", str]]) -> None:
+
+        # the deletions of a burst are resolved together so that
+        # removing a large tree does not walk the known files per path
+
+        deleted: List[str] = [path for change, path in changes if change == Change.deleted]
+
         for directory in self._directories:
 
-            new_files: Dict[str, str] = directory.check()
+            new_files: Dict[str, str] = {}
 
-            for k, v in new_files.items():
+            try:
 
-                if v == "new":
+                new_files.update(directory.process_deletions(deleted))
 
-                    # found a new file
-                    msg = f"NEW FILE:\n {k}"
+                for change, path in changes:
 
-                    self._speak(msg)
+                    if change != Change.deleted:
 
-                    logger.info(msg)
+                        new_files.update(directory.process_event(path, deleted=False))
 
-                elif v == "modified":
+            except Exception as e:
 
-                    # foun a modified file
+                self._log_check_error(directory, e)
 
-                    msg = f"MODIFIED FILE:\n {k}"
+            else:
 
-                    self._speak(msg)
+                self._check_ok(directory)
 
-                    logger.info(msg)
+            # keep what was already taken from the events
 
-    def listen(self):
+            self._queue_changes(directory, new_files)
 
+    def _notify_loop(self) -> None:
+        """
+        send the pending changes and error reports whenever a flush
+        asks for it, so that slow sends do not hold up the next check.
+        repeated failures back off here and are reported only once
 
-        self._speak("Starting up!")
+        """
+
+        consecutive_errors: int = 0
 
         while True:
 
+            self._changes_ready.wait()
+
+            self._changes_ready.clear()
+
+            if self._error_queued:
+
+                self._error_queued = False
+
+                self._report_error()
+
             try:
 
-                self._check_directories()
+                self._send_pending()
+
+            except Exception:
+
+                consecutive_errors += 1
+
+                self._handle_error(consecutive_errors)
+
+                # back off exponentially while the failure persists,
+                # the checks keep collecting changes in the meantime
+
+                self._closed.wait(
+                    min(
+                        max(self._wait_time, 1) * 2 ** min(consecutive_errors, 12),
+                        self._max_backoff,
+                    )
+                )
+
+            else:
+
+                consecutive_errors = 0
+
+            # close() sets the event after _closed, so anything
+            # queued during the last send is still picked up
+
+            if self._closed.is_set() and not self._changes_ready.is_set():
+
+                return
+
+    def _queue_error(self) -> None:
+        """
+        ask the notifier to tell the chat that something went wrong
+
+        :returns:
+        :rtype:
+
+        """
+
+        self._error_queued = True
+
+        self._changes_ready.set()
+
+    def _report_error(self) -> None:
+        """
+        let the chat know that something went wrong unless
+        telegram itself is unreachable
+
+        :returns:
+        :rtype:
+
+        """
+
+        if time.monotonic() < self._transport_bad_until:
+
+            logger.error("%s bot hit an error while telegram is unreachable", self._name)
+
+            return
+
+        try:
+
+            self._speak("Something went wrong!")
+
+        except Exception:
+
+            logger.error("%s bot could not report an error", self._name, exc_info=True)
+
+    def _handle_error(self, consecutive_errors: int) -> None:
+        """
+        log a failed send and tell the chat only about the
+        first failure in a row. must be called from an except block
+
+        :param consecutive_errors: how many sends failed in a row
+        :returns:
+        :rtype:
+
+        """
+
+        if consecutive_errors == 1:
+
+            logger.error("%s bot failed to send changes", self._name, exc_info=True)
+
+            self._report_error()
+
+        else:
+
+            logger.warning(
+                "%s bot failed to send changes %d times in a row",
+                self._name,
+                consecutive_errors,
+            )
+
+    def close(self) -> None:
+        """
+        release the scan pool, the notifier and the connection to telegram
+
+        :returns:
+        :rtype:
+
+        """
+
+        self._io_pool.shutdown(wait=False)
+
+        # let the notifier send what is left
+
+        self._closed.set()
+
+        self._changes_ready.set()
+
+        if self._notifier.is_alive():
+
+            self._notifier.join(timeout=self._close_timeout)
+
+        with self._pending_lock:
+
+            undelivered: int = len(self._pending)
+
+        if self._notifier.is_alive():
+
+            # still stuck in a send
+
+            undelivered += self._in_flight
+
+        if undelivered:
+
+            logger.error(
+                "%s bot is closing with %d undelivered changes", self._name, undelivered
+            )
+
+        self._request.stop()
+
+    def _poll(self) -> None:
+        """
+        rescan every directory each wait_time
+
+        """
+
+        next_check: float = time.monotonic()
+
+        while True:
+
+            # failing directories are logged and reported by
+            # _check_directories, failing sends by the notifier
+
+            self._check_directories()
+
+            self._flush()
+
+            # keep a fixed cadence on the monotonic clock instead of
+            # drifting by the time each check takes
+
+            next_check = max(next_check + self._wait_time, time.monotonic())
+
+            time.sleep(max(0.0, next_check - time.monotonic()))
+
+    def _watch(self) -> None:
+        """
+        let the OS tell us about changes. watchfiles waits until
+        the directories are quiet for the debounce time (or at most
+        wait_time) before handing over a burst of changes
+
+        """
+
+        for changes in watch(
+            *[directory._path for directory in self._directories],
+            debounce=self._wait_time * 1000,
+            step=int(self._debounce_time * 1000),
+            # Directory.process_event does the filtering, so both
+            # backends see the same files
+            watch_filter=None,
+        ):
+
+            self._handle_changes(changes)
+
+            self._flush()
+
+    def listen(self):
+
+
+        self._speak("Starting up!")
+
+        self._notifier.start()
+
+        try:
+
+            if self._force_polling or not has_watchfiles:
+
+                self._poll()
+
+            else:
 
-                time.sleep(self._wait_time)
+                self._watch()
 
-            except:
+        finally:
 
-                self._speak("Something went wrong!")
+            self.close()
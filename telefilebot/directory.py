@@ -1,90 +1,188 @@
-from logging import currentframe
+import os
 from pathlib import Path
-from typing import Optional, List, Dict
+from stat import S_ISDIR, S_ISREG
+from typing import Callable, Dict, FrozenSet, Iterable, List, Optional, Set, Tuple
 
 from .utils.logging import setup_logger
 
 
 log = setup_logger(__name__)
 
+# directories that are never worth watching
+
+DEFAULT_IGNORE_DIRS: FrozenSet[str] = frozenset(
+    {".git", ".hg", ".svn", "__pycache__", "node_modules", ".venv", "venv"}
+)
+
 
 class Directory:
-    def __init__(self, path, extensions=None, recursion_limit=None):
+    def __init__(
+        self,
+        path,
+        extensions=None,
+        recursion_limit=None,
+        ignore_dirs: Optional[Iterable[str]] = None,
+        ignore_fn: Optional[Callable[[str], bool]] = None,
+    ):
+        """
+        A directory to watch for changed files
+
+        :param path: the path of the directory
+        :param extensions: only watch files with these extensions
+        :param recursion_limit: how many levels of sub directories to watch
+        :param ignore_dirs: names of sub directories that are skipped,
+        defaults to DEFAULT_IGNORE_DIRS
+        :param ignore_fn: called with the relative path of each sub
+        directory, which is skipped if it returns True
+        :returns:
+
+        """
 
         self._path: Path = Path(path).expanduser().absolute()
 
+        # the path as a string ending in a separator, so relative
+        # names can be split off and joined on by plain slicing
+
+        self._path_str: str = os.path.join(str(self._path), "")
+
         # make sure the recursion_limit is at least 0
         if recursion_limit is not None:
 
             if recursion_limit < 0:
 
                 log.error(
-                    f"trying to set a recursion limit less than zero in {path}"
+                    "trying to set a recursion limit less than zero in %s", path
                 )
 
         self._recursion_limit: Optional[int] = recursion_limit
 
         self._extensions: Optional[List[str]] = extensions
 
-        self._known_files: Dict[str, float] = {}
+        # str.endswith takes a tuple, which matches all the
+        # extensions in a single call
+
+        self._extensions_tuple: Optional[Tuple[str, ...]] = (
+            tuple(extensions) if extensions is not None else None
+        )
+
+        self._ignore_dirs: FrozenSet[str] = (
+            DEFAULT_IGNORE_DIRS if ignore_dirs is None else frozenset(ignore_dirs)
+        )
 
-        log.info(f"Created a watch in {self._path}")
+        self._ignore_fn: Optional[Callable[[str], bool]] = ignore_fn
+
+        log.info("Created a watch in %s", self._path)
 
         if self._recursion_limit is not None:
 
-            log.info(f"with a recursion limit of {self._recursion_limit}")
+            log.info("with a recursion limit of %d", self._recursion_limit)
 
         if self._extensions is not None:
 
             for ext in self._extensions:
 
-                log.info(f" searching for extension {ext}")
+                log.info(" searching for extension %s", ext)
 
         # now look for the initial set of files
         log.info("Initalizing the file list")
 
-        initial_files = self._descend_directory(self._path, current_depth=0)
-
-        for k, v in initial_files.items():
-
-            self._known_files[k] = v
+        self._known_files: Dict[str, float] = self._descend_directory()
 
-            log.info(f"inital file: {k}")
+        log.info("initial file list: %d files", len(self._known_files))
 
     def _descend_directory(
-        self, path: Path, current_depth: int
+        self, path: Optional[str] = None, current_depth: int = 0, rel_prefix: str = ""
     ) -> Dict[str, float]:
         """
-        recursively descend a directory until a recursion limit is
+        descend the directory until a recursion limit is
         reached and return all the files needed
 
+        the walk keeps its own stack of directories instead of
+        recursing, so all files go straight into one dict
+
+        :param path: the directory to start from, defaults to the
+        watched path
+        :param current_depth: the depth of path below the watched path
+        :param rel_prefix: path relative to the watched path, ending
+        in a separator
+        :returns:
+
         """
         collected_files: Dict[str, float] = {}
 
-        log.debug(f"checking dir {path} at a depth of {current_depth}")
+        # (path, depth, path relative to the watched path)
 
-        for x in path.iterdir():
+        stack: List[Tuple[str, int, str]] = [
+            (self._path_str if path is None else path, current_depth, rel_prefix)
+        ]
 
-            if x.is_file():
+        start_prefix: str = rel_prefix
 
-                extension = x.suffix
+        while stack:
 
-                if self._extensions is not None:
+            path, current_depth, rel_prefix = stack.pop()
 
-                    # if this is not what we are looking for
+            log.debug("checking dir %s at a depth of %d", path, current_depth)
 
-                    if extension not in self._extensions:
+            # scandir hands us the file type from the directory listing
+            # so we only have to stat the files we keep
 
-                        continue
+            try:
+
+                it = os.scandir(path)
+
+            except FileNotFoundError:
+
+                # a missing start is an error for the caller, a sub
+                # directory can just vanish while we walk
+
+                if rel_prefix == start_prefix:
+
+                    raise
 
-                # ok, this is something we want to keep
-                # so record when it was modified
+                continue
 
-                collected_files[
-                    str(x.relative_to(self._path))
-                ] = x.stat().st_mtime
+            with it:
 
-            elif x.is_dir():
+                self._scan_entries(
+                    it, current_depth, rel_prefix, collected_files, stack
+                )
+
+        return collected_files
+
+    def _scan_entries(
+        self,
+        entries: Iterable[os.DirEntry],
+        current_depth: int,
+        rel_prefix: str,
+        collected_files: Dict[str, float],
+        stack: List[Tuple[str, int, str]],
+    ) -> None:
+        """
+        sort the entries of one directory listing into the files we
+        keep and the sub directories still to walk
+
+        :param entries: the scandir listing
+        :param current_depth: the depth of the listed directory
+        :param rel_prefix: its path relative to the watched path,
+        ending in a separator
+        :param collected_files: the files found so far
+        :param stack: the directories still to walk
+        :returns:
+
+        """
+
+        for entry in entries:
+
+            if entry.is_file():
+
+                mtime: Optional[float] = self._wanted_mtime(entry)
+
+                if mtime is not None:
+
+                    collected_files[rel_prefix + entry.name] = mtime
+
+            elif entry.is_dir():
 
                 if self._recursion_limit is not None:
 
@@ -92,68 +190,359 @@ class Directory:
 
                         continue
 
+                if self._is_ignored(entry.name, rel_prefix + entry.name):
+
+                    continue
+
                 # ok we will descend the directory
 
-                sub_files: Dict[str, float] = self._descend_directory(
-                    x, current_depth=current_depth + 1
+                stack.append(
+                    (entry.path, current_depth + 1, rel_prefix + entry.name + os.sep)
                 )
 
-                for k, v in sub_files.items():
+    def _wanted_mtime(self, entry: os.DirEntry) -> Optional[float]:
+        """
+        when a listed file was modified, or None if we
+        do not keep it
 
-                    collected_files[k] = v
+        :param entry: the file from the scandir listing
+        :returns:
 
-        return collected_files
+        """
+
+        if self._extensions_tuple is not None:
+
+            # if this is not what we are looking for
+
+            if not entry.name.endswith(self._extensions_tuple):
+
+                return None
+
+        # ok, this is something we want to keep
+        # so record when it was modified
+
+        try:
+
+            return entry.stat().st_mtime
+
+        except FileNotFoundError:
+
+            # deleted since it was listed
+
+            return None
+
+    def _is_ignored(self, name: str, rel_path: str) -> bool:
+        """
+        if a sub directory should not be watched
+
+        :param name: the name of the sub directory
+        :param rel_path: its path relative to the watched path
+        :returns:
+
+        """
+
+        if name in self._ignore_dirs:
+
+            return True
+
+        return self._ignore_fn is not None and self._ignore_fn(rel_path)
 
     def check(self) -> Dict[str, str]:
         """
         check the current directory against the known file
         list
 
+        this blocks on the file system and is meant to run in a
+        worker thread. It only touches this directory's known file
+        list, so it is safe as long as a directory is not checked
+        by two threads at once (the bot submits each directory once
+        per tick)
+
         """
 
         new_files: Dict[str, str] = {}
 
-        new_listings: Dict[str, float] = self._descend_directory(
-            self._path, current_depth=0
-        )
+        new_listings: Dict[str, float] = self._descend_directory()
+
+        known_files: Dict[str, float] = self._known_files
+
+        # one lookup per file tells us if it is new or modified
 
         for k, v in new_listings.items():
 
-            # first check the known files and
-            # see if one of these has been modified
-            # since the last check
+            old = known_files.get(k)
 
-            if k in self._known_files:
+            if old is None:
 
-                # compare the times
+                new_files[k] = "new"
 
-                if self._known_files[k] < v:
+                log.debug("updated the known file list with %s", k)
 
-                    # this file has been modified
+            elif old < v:
 
-                    new_files[k] = "modified"
+                new_files[k] = "modified"
 
-                    # now lets update the time
-                    # in the original list
+                log.debug("%s is moving its time from %r to %r", k, old, v)
 
-                    log.debug(
-                        f"{k} is moving its time from {self._known_files[k]} to {v}"
-                    )
+        # the key views of the two listings behave like sets, so
+        # the deleted files fall out of a set difference done in C
 
-                    self._known_files[k] = v
+        for k in known_files.keys() - new_listings.keys():
 
-            else:
+            new_files[k] = "deleted"
 
-                # this is a new file
+            log.debug("removed %s from the known file list", k)
 
-                new_files[k] = "new"
+        # the new listing is exactly what we know now
+
+        self._known_files = new_listings
+
+        log.debug("finished checking %s", self._path)
+
+        return new_files
+
+    def process_event(self, path: str, deleted: bool) -> Dict[str, str]:
+        """
+        update the known file list from a single file system
+        event and return the change it causes (if any) in the
+        same form as check
+
+        :param path: the absolute path reported by the watcher
+        :param deleted: if the path was removed
+        :returns:
+
+        """
+
+        if deleted:
+
+            return self.process_deletions([path])
+
+        new_files: Dict[str, str] = {}
+
+        k: Optional[str] = self._event_key(path)
+
+        if k is None:
 
-                # lets add it to the known list
+            return new_files
 
-                self._known_files[k] = v
+        try:
 
-                log.debug(f"updated the known file list with {k}")
+            stat = os.stat(path)
 
-        log.debug(f"finished checking {self._path}")
+        except OSError:
+
+            # the file is already gone again
+
+            return new_files
+
+        if S_ISDIR(stat.st_mode):
+
+            self._add_directory(path, k, new_files)
+
+        elif S_ISREG(stat.st_mode):
+
+            self._add_file(path, k, stat.st_mtime, new_files)
 
         return new_files
+
+    def process_deletions(self, paths: Iterable[str]) -> Dict[str, str]:
+        """
+        update the known file list from the deletion events of a
+        burst and return the changes they cause in the same form
+        as check. Known files are dropped with one lookup each, and
+        all paths that may have been directories are resolved
+        together in a single pass over the known files
+
+        :param paths: the absolute paths reported as deleted
+        :returns:
+
+        """
+
+        new_files: Dict[str, str] = {}
+
+        maybe_dirs: Set[str] = set()
+
+        for path in paths:
+
+            k: Optional[str] = self._event_key(path)
+
+            # events of a burst come unordered, so only believe a
+            # deletion if the path is really gone
+
+            if k is None or os.path.lexists(path):
+
+                continue
+
+            if self._known_files.pop(k, None) is not None:
+
+                new_files[k] = "deleted"
+
+            elif not self._is_ignored(os.path.basename(k), k):
+
+                # not a file we know, so it may have been a
+                # directory with known files below it
+
+                maybe_dirs.add(k)
+
+        if maybe_dirs:
+
+            self._drop_directories(maybe_dirs, new_files)
+
+        return new_files
+
+    def _event_key(self, path: str) -> Optional[str]:
+        """
+        the known file key of an event path, or None if the
+        path is not ours or lies below an ignored sub directory
+
+        :param path: the absolute path reported by the watcher
+        :returns:
+
+        """
+
+        if not path.startswith(self._path_str):
+
+            # this event belongs to another directory
+
+            return None
+
+        k = path[len(self._path_str):]
+
+        dir_names: List[str] = k.split(os.sep)[:-1]
+
+        for i, name in enumerate(dir_names):
+
+            if self._is_ignored(name, os.sep.join(dir_names[: i + 1])):
+
+                return None
+
+        return k
+
+    def _drop_directories(self, dirs: Set[str], new_files: Dict[str, str]) -> None:
+        """
+        drop every known file below one of the deleted directories
+
+        :param dirs: the deleted directories relative to the watched path
+        :param new_files: the changes to add to
+        :returns:
+
+        """
+
+        gone: List[str] = []
+
+        for known in self._known_files:
+
+            # look up each parent of the file instead of comparing
+            # it against every deleted directory
+
+            i = known.find(os.sep)
+
+            while i != -1:
+
+                if known[:i] in dirs:
+
+                    gone.append(known)
+
+                    break
+
+                i = known.find(os.sep, i + 1)
+
+        for known in gone:
+
+            new_files[known] = "deleted"
+
+            del self._known_files[known]
+
+    def _add_directory(self, path: str, k: str, new_files: Dict[str, str]) -> None:
+        """
+        pick up the files of a directory that appeared. a directory
+        moved in does not send events for the files inside it
+
+        :param path: the absolute path of the directory
+        :param k: its path relative to the watched path
+        :param new_files: the changes to add to
+        :returns:
+
+        """
+
+        depth = k.count(os.sep) + 1
+
+        if self._recursion_limit is not None and depth > self._recursion_limit:
+
+            return
+
+        if self._is_ignored(os.path.basename(k), k):
+
+            return
+
+        try:
+
+            listing = self._descend_directory(
+                path, current_depth=depth, rel_prefix=k + os.sep
+            )
+
+        except FileNotFoundError:
+
+            # it is already gone again
+
+            return
+
+        for rel_path, mtime in listing.items():
+
+            self._record_file(rel_path, mtime, new_files)
+
+    def _add_file(
+        self, path: str, k: str, mtime: float, new_files: Dict[str, str]
+    ) -> None:
+        """
+        record a regular file from an event if we watch it
+
+        :param path: the absolute path of the file
+        :param k: its path relative to the watched path
+        :param mtime: the modification time of the file
+        :param new_files: the changes to add to
+        :returns:
+
+        """
+
+        if self._recursion_limit is not None:
+
+            if k.count(os.sep) > self._recursion_limit:
+
+                return
+
+        if self._extensions_tuple is not None:
+
+            if not path.endswith(self._extensions_tuple):
+
+                return
+
+        self._record_file(k, mtime, new_files)
+
+    def _record_file(self, k: str, mtime: float, new_files: Dict[str, str]) -> None:
+        """
+        add a file to the known file list and note if it is
+        new or modified
+
+        :param k: the path relative to the watched path
+        :param mtime: the modification time of the file
+        :param new_files: the changes to add to
+        :returns:
+
+        """
+
+        old = self._known_files.get(k)
+
+        if old is None:
+
+            new_files[k] = "new"
+
+        elif old < mtime:
+
+            new_files[k] = "modified"
+
+        else:
+
+            return
+
+        self._known_files[k] = mtime
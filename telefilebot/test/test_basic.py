@@ -1,7 +1,11 @@
 import pytest
+import shutil
 import time
 from pathlib import Path
 
+from telegram.error import Unauthorized
+
+from telefilebot.bot import TeleFileBot, _TokenBucket, _split_message
 from telefilebot.directory import Directory
 from telefilebot.utils.logging import update_logging_level
 
@@ -109,3 +113,431 @@ def test_directory_ext(test_dir):
     new_time = d._known_files["file.txt"]
 
     assert new_time > old_time
+
+
+def test_directory_events(test_dir):
+
+
+    d = Directory(path=test_dir, recursion_limit=0, extensions=[".txt"])
+
+    p = Path(test_dir)
+
+
+    new_file = p / "new.txt"
+
+    new_file.touch()
+
+    assert d.process_event(str(new_file.absolute()), deleted=False) == {"new.txt": "new"}
+
+    assert d.process_event(str(new_file.absolute()), deleted=False) == {}
+
+
+    ignored = p / "test.f"
+
+    ignored.touch()
+
+    assert d.process_event(str(ignored.absolute()), deleted=False) == {}
+
+
+    new_dir = p / "one"
+
+    new_dir.mkdir()
+
+    deep_file = new_dir / "help.txt"
+
+    deep_file.touch()
+
+    assert d.process_event(str(deep_file.absolute()), deleted=False) == {}
+
+
+    new_file.unlink()
+
+    assert d.process_event(str(new_file.absolute()), deleted=True) == {"new.txt": "deleted"}
+
+    assert "new.txt" not in d._known_files
+
+
+    # a late deletion event for a file that is back again
+
+    new_file.touch()
+
+    assert d.process_event(str(new_file.absolute()), deleted=False) == {"new.txt": "new"}
+
+    assert d.process_event(str(new_file.absolute()), deleted=True) == {}
+
+    assert "new.txt" in d._known_files
+
+
+    (p / "file.txt").unlink()
+
+    assert d.check() == {"file.txt": "deleted"}
+
+
+def test_directory_moved(test_dir, tmp_path):
+
+
+    d = Directory(path=test_dir, recursion_limit=None, extensions=None)
+
+    p = Path(test_dir)
+
+
+    # only the directory itself sends an event when it is moved in
+
+    outside = tmp_path / "sub"
+
+    (outside / "deep").mkdir(parents=True)
+
+    (outside / "g.txt").touch()
+
+    (outside / "deep" / "h.txt").touch()
+
+    inside = p / "sub"
+
+    outside.rename(inside)
+
+    assert d.process_event(str(inside.absolute()), deleted=False) == {
+        "sub/g.txt": "new",
+        "sub/deep/h.txt": "new",
+    }
+
+
+    # and when it is moved out again
+
+    inside.rename(outside)
+
+    assert d.process_event(str(inside.absolute()), deleted=True) == {
+        "sub/g.txt": "deleted",
+        "sub/deep/h.txt": "deleted",
+    }
+
+    assert list(d._known_files) == ["file.txt"]
+
+
+def test_directory_deletions(test_dir):
+
+    p = Path(test_dir)
+
+    (p / "sub" / "deep").mkdir(parents=True)
+
+    for name in ("a.txt", "b.txt", "sub/c.txt", "sub/deep/d.txt"):
+
+        (p / name).touch()
+
+    d = Directory(path=test_dir)
+
+    d._known_files = NoScanDict(d._known_files)
+
+    # a known file is dropped without walking the known files
+
+    (p / "a.txt").unlink()
+
+    assert d.process_event(str((p / "a.txt").absolute()), deleted=True) == {
+        "a.txt": "deleted"
+    }
+
+    # a burst with files and a directory is resolved in one pass
+
+    d._known_files = dict(d._known_files)
+
+    (p / "b.txt").unlink()
+
+    shutil.rmtree(p / "sub")
+
+    burst = [str((p / name).absolute()) for name in ("b.txt", "sub/deep", "sub")]
+
+    assert d.process_deletions(burst) == {
+        "b.txt": "deleted",
+        "sub/c.txt": "deleted",
+        "sub/deep/d.txt": "deleted",
+    }
+
+    assert list(d._known_files) == ["file.txt"]
+
+
+def test_directory_ignore(test_dir):
+
+    p = Path(test_dir)
+
+    for sub in (".git", "build", "src"):
+
+        (p / sub).mkdir()
+
+        (p / sub / "a.txt").touch()
+
+
+    d = Directory(path=test_dir, ignore_fn=lambda rel: rel == "build")
+
+    assert "src/a.txt" in d._known_files
+
+    assert ".git/a.txt" not in d._known_files
+
+    assert "build/a.txt" not in d._known_files
+
+    ignored = p / ".git" / "b.txt"
+
+    ignored.touch()
+
+    assert d.process_event(str(ignored.absolute()), deleted=False) == {}
+
+
+    d = Directory(path=test_dir, ignore_dirs=[])
+
+    assert ".git/a.txt" in d._known_files
+
+
+class NoScanDict(dict):
+    # fails the test if the known file list is walked
+
+    def __iter__(self):
+
+        raise AssertionError("the known file list was scanned")
+
+
+def test_directory_ignore_deleted(test_dir):
+
+    p = Path(test_dir)
+
+    (p / ".git" / "objects").mkdir(parents=True)
+
+    (p / "a.txt").touch()
+
+    d = Directory(path=test_dir)
+
+    d._known_files = NoScanDict(d._known_files)
+
+    # events below an ignored directory return before any lookup
+
+    for name in ("b.txt", "objects"):
+
+        gone = p / ".git" / name
+
+        assert d.process_event(str(gone.absolute()), deleted=True) == {}
+
+    assert "a.txt" in d._known_files
+
+
+def test_token_bucket():
+
+    bucket = _TokenBucket(capacity=2, rate=1.0)
+
+    now = bucket.last
+
+    assert bucket.time_until_token(now) == 0
+
+    bucket.tokens -= 2
+
+    assert bucket.time_until_token(now) == pytest.approx(1.0)
+
+    bucket.refill(now + 10)
+
+    assert bucket.tokens == 2
+
+
+def test_token_bucket_adapts():
+
+    bucket = _TokenBucket(capacity=2, rate=1.0, rate_min=0.1, rate_max=1.0)
+
+    bucket.decrease_rate(0.5, retry_after=5)
+
+    assert bucket.rate == 0.5
+
+    assert bucket.tokens == 0
+
+    # no tokens come back while telegram asked us to wait
+
+    paused = bucket.last
+
+    bucket.refill(paused - 1)
+
+    assert bucket.tokens == 0
+
+    assert bucket.time_until_token(paused) == pytest.approx(2.0)
+
+    bucket.increase_rate(10)
+
+    assert bucket.rate == 1.0
+
+
+def test_coalesce_changes(test_dir):
+
+    d = Directory(path=test_dir, recursion_limit=None, extensions=None)
+
+    bot = TeleFileBot(
+        name="test", token="123:abc", chat_id="1", directories=[d], wait_time=1
+    )
+
+    sent = []
+
+    bot._speak = sent.append
+
+    bot._queue_changes(d, {"a.txt": "new", "b.txt": "new", "file.txt": "deleted"})
+
+    bot._queue_changes(d, {"a.txt": "modified", "b.txt": "deleted", "file.txt": "new"})
+
+    bot._send_pending()
+
+    bot.close()
+
+    assert len(sent) == 1
+
+    assert "NEW FILES (1)" in sent[0]
+
+    assert "a.txt" in sent[0]
+
+    assert "b.txt" not in sent[0]
+
+    assert "MODIFIED FILES (1)" in sent[0]
+
+    assert bot._pending == {}
+
+
+def test_missing_directory(tmp_path):
+
+    root = tmp_path / "watched"
+
+    (root / "sub").mkdir(parents=True)
+
+    (root / "sub" / "a.txt").touch()
+
+    d = Directory(path=root, recursion_limit=None, extensions=None)
+
+    bot = TeleFileBot(
+        name="test", token="123:abc", chat_id="1", directories=[d], wait_time=1
+    )
+
+    (root / "sub" / "a.txt").unlink()
+
+    (root / "sub").rmdir()
+
+    root.rmdir()
+
+    with pytest.raises(FileNotFoundError):
+
+        d.check()
+
+    # a missing root is reported once, not on every pass
+
+    bot._check_directories()
+
+    assert bot._error_queued
+
+    bot._error_queued = False
+
+    bot._check_directories()
+
+    assert not bot._error_queued
+
+    root.mkdir()
+
+    bot._check_directories()
+
+    assert bot._failing == set()
+
+    bot.close()
+
+
+class FakeTelegram:
+    def __init__(self, error=None):
+
+        self.error = error
+
+        self.sent = []
+
+    def send_message(self, chat_id, text):
+
+        self.sent.append(text)
+
+        if self.error is not None:
+
+            raise self.error
+
+
+def test_notifier(test_dir):
+
+    d = Directory(path=test_dir, recursion_limit=None, extensions=None)
+
+    bot = TeleFileBot(
+        name="test", token="123:abc", chat_id="1", directories=[d], wait_time=1
+    )
+
+    fake = FakeTelegram()
+
+    bot._bot = fake
+
+    bot._notifier.start()
+
+    bot._queue_changes(d, {"a.txt": "new"})
+
+    bot._flush()
+
+    # close waits for the notifier to send what is left
+
+    bot._queue_changes(d, {"b.txt": "modified"})
+
+    bot.close()
+
+    assert not bot._notifier.is_alive()
+
+    assert "a.txt" in "".join(fake.sent)
+
+    assert "b.txt" in "".join(fake.sent)
+
+    assert bot._pending == {}
+
+
+def test_notifier_errors(test_dir):
+
+    d = Directory(path=test_dir, recursion_limit=None, extensions=None)
+
+    bot = TeleFileBot(
+        name="test", token="123:abc", chat_id="1", directories=[d], wait_time=1
+    )
+
+    fake = FakeTelegram(error=Unauthorized("nope"))
+
+    bot._bot = fake
+
+    bot._max_backoff = 0.01
+
+    bot._notifier.start()
+
+    for i in range(3):
+
+        bot._queue_changes(d, {f"{i}.txt": "new"})
+
+        bot._flush()
+
+        time.sleep(0.1)
+
+    bot.close()
+
+    assert not bot._notifier.is_alive()
+
+    # every change was tried but only the first failure was reported
+
+    for i in range(3):
+
+        assert f"{i}.txt" in "".join(fake.sent)
+
+    assert len(fake.sent) > 2
+
+    assert fake.sent.count("Something went wrong!") == 1
+
+
+def test_split_message():
+
+    assert _split_message("short") == ["short"]
+
+    lines = [f"file_{i}.txt" for i in range(1000)]
+
+    parts = _split_message("\n".join(lines), max_length=100)
+
+    assert len(parts) > 1
+
+    assert parts[0].startswith(f"(1/{len(parts)})\n")
+
+    assert all(len(part) <= 100 + len(f"({len(parts)}/{len(parts)})\n") for part in parts)
+
+    recovered = [line for part in parts for line in part.split("\n")[1:]]
+
+    assert recovered == lines
@@ -1,10 +1,13 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from pathlib import Path
-from typing import List, Optional
+from typing import TYPE_CHECKING, List, Optional
 
 from omegaconf import OmegaConf
 from omegaconf.dictconfig import DictConfig
-from rich.tree import Tree
+
+if TYPE_CHECKING:
+
+    from rich.tree import Tree
 
 # Path to configuration
 
@@ -27,7 +30,7 @@ class Logging:
 @dataclass
 class TelefilebotConfig:
 
-    logging: Logging = Logging()
+    logging: Logging = field(default_factory=Logging)
 
 
 # Read the default config
@@ -76,7 +79,11 @@ def recurse_dict(d, tree) -> None:
     return
 
 
-def show_configuration() -> Tree:
+def show_configuration() -> "Tree":
+
+    # only pay for rich.tree when the configuration is shown
+
+    from rich.tree import Tree
 
     tree = Tree(
         "config", guide_style="bold medium_orchid", style="bold medium_orchid"
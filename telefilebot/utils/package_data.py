@@ -1,8 +1,10 @@
+from functools import lru_cache
 from pathlib import Path
 
 import pkg_resources
 
 
+@lru_cache(maxsize=1)
 def get_path_of_data_dir() -> Path:
     """
     get the path of the package data directory
@@ -24,6 +24,7 @@ class DirectoryListing:
 
     recursion_limit: Optional[int] = None
     extensions: Optional[List[str]] = None
+    ignore_dirs: Optional[List[str]] = None
 
 
 @dataclass
@@ -33,8 +34,9 @@ class InputFile:
     token: str = ""
     chat_id: str = ""
     directories: Dict[str, DirectoryListing] = field(default_factory=lambda: {})
-    logging: Logging = Logging()
+    logging: Logging = field(default_factory=Logging)
     wait_time: float = 1  # minute
+    force_polling: bool = False
 
 
 def read_input_file(file_name: str) -> InputFile: